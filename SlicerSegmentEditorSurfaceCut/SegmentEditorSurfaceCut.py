@@ -44,6 +44,8 @@ class SegmentEditorSurfaceCutTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_SurfaceCut1()
+    self.setUp()
+    self.test_SurfaceCutFractional()
 
   def test_SurfaceCut1(self):
     """
@@ -137,3 +139,129 @@ class SegmentEditorSurfaceCutTest(ScriptedLoadableModuleTest):
     self.assertEqual( round(segStatLogic.statistics["Background","LM volume cc"]), 3010)
 
     self.delayDisplay('test_SurfaceCut1 passed')
+
+  def test_SurfaceCutFractional(self):
+    """
+    Test of fractional output:
+    - Check coverage of a surface at known sub-voxel offsets, with both surface windings
+    - Cut a box-shaped surface with fractional output enabled, for all operations
+    - Verify that the fractional labelmap thresholded at 0 matches the binary labelmap
+    - Verify that the fractional volume matches the volume enclosed by the surface
+    """
+
+    self.delayDisplay("Starting test_SurfaceCutFractional")
+
+    import numpy
+    import SampleData
+
+    ##################################
+    self.delayDisplay("Load master volume")
+
+    sampleDataLogic = SampleData.SampleDataLogic()
+    masterVolumeNode = sampleDataLogic.downloadMRBrainTumor1()
+
+    segmentationNode = slicer.vtkMRMLSegmentationNode()
+    slicer.mrmlScene.AddNode(segmentationNode)
+    segmentationNode.CreateDefaultDisplayNodes()
+    segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(masterVolumeNode)
+    segmentationNode.GetSegmentation().AddEmptySegment("FILL_INSIDE")
+
+    segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
+    segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
+    segmentEditorNode = slicer.vtkMRMLSegmentEditorNode()
+    slicer.mrmlScene.AddNode(segmentEditorNode)
+    segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
+    segmentEditorWidget.setSegmentationNode(segmentationNode)
+    segmentEditorWidget.setMasterVolumeNode(masterVolumeNode)
+    segmentEditorWidget.setCurrentSegmentID("FILL_INSIDE")
+    segmentEditorWidget.setActiveEffectByName("Surface cut")
+
+    ##################################
+    self.delayDisplay("Check coverage at known sub-voxel offsets")
+
+    # Box in IJK coordinates with faces at x = 0.3 and x = 8.2, covering voxels 1..8
+    cube = vtk.vtkCubeSource()
+    cube.SetBounds(0.3, 8.2, 0.3, 8.2, 0.3, 8.2)
+    triangulator = vtk.vtkTriangleFilter()
+    triangulator.SetInputConnection(cube.GetOutputPort())
+    coverageExtent = [-2, 10, -2, 10, -2, 10]
+    insideMask = numpy.zeros((13, 13, 13), dtype=bool)
+    insideMask[3:11, 3:11, 3:11] = True
+    for reverseWinding in (False, True):
+      reverse = vtk.vtkReverseSense()
+      reverse.SetInputConnection(triangulator.GetOutputPort())
+      reverse.SetReverseCells(reverseWinding)
+      reverse.SetReverseNormals(reverseWinding)
+      reverse.Update()
+      coverage = segmentEditorWidget.activeEffect().self().computeSurfaceCoverage(reverse.GetOutput(), insideMask, coverageExtent)
+      # Array index is IJK + 2; values are checked at the center of the faces (J = K = 4)
+      self.assertAlmostEqual(coverage[6, 6, 2], 0.2, places=5)  # voxel 0 is outside, [0.3, 0.5] is covered
+      self.assertAlmostEqual(coverage[6, 6, 3], 1.0, places=5)  # voxel 1 is inside, 0.7 from the face
+      self.assertAlmostEqual(coverage[6, 6, 10], 0.7, places=5)  # voxel 8 is inside, [7.5, 8.2] is covered
+      self.assertAlmostEqual(coverage[6, 6, 11], 0.0, places=5)  # voxel 9 is outside, 0.8 from the face
+      self.assertAlmostEqual(coverage[6, 6, 6], 1.0, places=5)  # interior voxel is not evaluated
+
+    ##################################
+    bounds = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+    masterVolumeNode.GetRASBounds(bounds)
+    center = [(bounds[0] + bounds[1]) / 2.0, (bounds[2] + bounds[3]) / 2.0, (bounds[4] + bounds[5]) / 2.0]
+    spacing = masterVolumeNode.GetSpacing()
+    voxelVolume = spacing[0] * spacing[1] * spacing[2]
+
+    def applySurface(operationName, halfSize):
+      """Apply the operation with a box-shaped surface and return the volume enclosed by the surface"""
+      effect = segmentEditorWidget.activeEffect()
+      effect.setParameter("Operation", operationName)
+      effectSelf = effect.self()
+      effectSelf.segmentModel = slicer.vtkMRMLModelNode()
+      slicer.mrmlScene.AddNode(effectSelf.segmentModel)
+      # Slightly skewed box, so that the surface is oblique to the voxel grid
+      for x in (-1, 1):
+        for y in (-1, 1):
+          for z in (-1, 1):
+            effectSelf.segmentMarkupNode.AddFiducial(center[0] + x * halfSize + y * 3.0,
+              center[1] + y * halfSize + z * 3.0, center[2] + z * halfSize + x * 3.0)
+      massProperties = vtk.vtkMassProperties()
+      massProperties.SetInputData(effectSelf.segmentModel.GetPolyData())
+      massProperties.Update()
+      effectSelf.onApply()
+      return massProperties.GetVolume()
+
+    for operationName in ["FILL_INSIDE", "FILL_OUTSIDE", "ERASE_INSIDE", "ERASE_OUTSIDE", "SET"]:
+      self.delayDisplay("Apply " + operationName)
+      segmentID = operationName
+      if not segmentationNode.GetSegmentation().GetSegment(segmentID):
+        segmentationNode.GetSegmentation().AddEmptySegment(segmentID)
+      segmentEditorWidget.setCurrentSegmentID(segmentID)
+      segmentEditorWidget.setActiveEffectByName("Surface cut")
+      segmentEditorWidget.activeEffect().setParameter("FractionalOutput", 0)
+      largeSurfaceVolume = 0.0
+      if operationName in ("ERASE_INSIDE", "ERASE_OUTSIDE"):
+        # Erase from a larger segment
+        largeSurfaceVolume = applySurface("FILL_INSIDE", 40.0)
+      segmentEditorWidget.activeEffect().setParameter("FractionalOutput", 1)
+      surfaceVolume = applySurface(operationName, 20.0)
+
+      fractionalArray = slicer.util.arrayFromVolume(slicer.util.getNode(operationName + " " + operationName + " fractional"))
+
+      labelmapNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+      segmentIDs = vtk.vtkStringArray()
+      segmentIDs.InsertNextValue(segmentID)
+      slicer.vtkSlicerSegmentationsModuleLogic.ExportSegmentsToLabelmapNode(segmentationNode, segmentIDs, labelmapNode, masterVolumeNode)
+      binaryMask = slicer.util.arrayFromVolume(labelmapNode) > 0
+
+      self.assertEqual(fractionalArray.shape, binaryMask.shape)
+      self.assertTrue(numpy.array_equal(fractionalArray > 0, binaryMask))
+      self.assertTrue(((fractionalArray > -108) & (fractionalArray < 108)).any())
+
+      # Volume of the segment inside the large surface is known for operations that do not depend on the volume extent
+      if operationName in ("FILL_INSIDE", "SET", "ERASE_OUTSIDE"):
+        expectedVolume = surfaceVolume
+      elif operationName == "ERASE_INSIDE":
+        expectedVolume = largeSurfaceVolume - surfaceVolume
+      else:
+        continue
+      fractionalVolume = ((fractionalArray.astype(numpy.float64) + 108.0) / 216.0).sum() * voxelVolume
+      self.assertLess(abs(fractionalVolume - expectedVolume), 0.01 * expectedVolume)
+
+    self.delayDisplay('test_SurfaceCutFractional passed')
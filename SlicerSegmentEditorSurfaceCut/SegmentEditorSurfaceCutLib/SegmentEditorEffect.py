@@ -37,6 +37,8 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
 
   def helpText(self):
     return """<html>Use markup fiducials to fill a segment<br>. The surface is generated from the placed points.
+Enable <b>Fractional output</b> to also store the partial-volume coverage of the segment after the cut in a new volume
+(named after the segment and the operation, -108 = empty, 108 = full). The volume is not updated by undo or later edits.
 </html>"""
 
   def setupOptionsFrame(self):
@@ -75,6 +77,13 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
     self.operationRadioButtons[2].setChecked(True)
     self.scriptedEffect.addLabeledOptionsWidget("Operation:", operationLayout)
 
+    # Fractional output checkbox
+    self.fractionalOutputCheckBox = qt.QCheckBox("Fractional output")
+    self.fractionalOutputCheckBox.objectName = self.__class__.__name__ + 'FractionalOutput'
+    self.fractionalOutputCheckBox.setToolTip("Also store the partial-volume coverage of the segment after the cut in a new volume (-108 = empty, 108 = full)."
+      " The volume is not updated by undo or later edits.")
+    self.scriptedEffect.addOptionsWidget(self.fractionalOutputCheckBox)
+
     #Fiducial Placement widget
     self.fiducialPlacementToggle = slicer.qSlicerMarkupsPlaceWidget()
     self.fiducialPlacementToggle.setMRMLScene(slicer.mrmlScene)
@@ -115,6 +124,7 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
     for button in self.operationRadioButtons:
       button.connect('toggled(bool)',
       lambda toggle, widget=self.buttonToOperationNameMap[button]: self.onOperationSelectionChanged(widget, toggle))
+    self.fractionalOutputCheckBox.connect('toggled(bool)', self.onFractionalOutputToggled)
     self.applyButton.connect('clicked()', self.onApply)
     self.cancelButton.connect('clicked()', self.onCancel)
     self.editButton.connect('clicked()', self.onEdit)
@@ -142,8 +152,13 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
 
   def setMRMLDefaults(self):
     self.scriptedEffect.setParameterDefault("Operation", "FILL_INSIDE")
+    self.scriptedEffect.setParameterDefault("FractionalOutput", 0)
 
   def updateGUIFromMRML(self):
+    wasBlocked = self.fractionalOutputCheckBox.blockSignals(True)
+    self.fractionalOutputCheckBox.setChecked(self.scriptedEffect.integerParameter("FractionalOutput") != 0)
+    self.fractionalOutputCheckBox.blockSignals(wasBlocked)
+
     if self.segmentMarkupNode:
       self.cancelButton.setEnabled(self.segmentMarkupNode.GetNumberOfFiducials() is not 0)
       self.applyButton.setEnabled(self.segmentMarkupNode.GetNumberOfFiducials() >= 3)
@@ -164,6 +179,9 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
       return
     self.scriptedEffect.setParameter("Operation", operationName)
 
+  def onFractionalOutputToggled(self, toggle):
+    self.scriptedEffect.setParameter("FractionalOutput", 1 if toggle else 0)
+
   def onFiducialPlacementToggleChanged(self):
     if self.fiducialPlacementToggle.placeButton().isChecked():
       # Create empty model node
@@ -304,6 +322,17 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
 
       vtkSegmentationCore.vtkOrientedImageDataResample.ModifyImage(modifierLabelmap, orientedStencilPositionerOuput, vtkSegmentationCore.vtkOrientedImageDataResample.OPERATION_MAXIMUM)
 
+      segmentID = self.scriptedEffect.parameterSetNode().GetSelectedSegmentID()
+      segment = segmentationNode.GetSegmentation().GetSegment(segmentID)
+
+      fractionalRegion = None
+      previousRegionLabelmap = None
+      if self.scriptedEffect.integerParameter("FractionalOutput") != 0:
+        fractionalRegion = self.fractionalRegionGeometry(WorldToModifierLabelmapIjkTransformer.GetOutput(), modifierLabelmap)
+        if fractionalRegion:
+          # Segment content before the edit is needed for compositing the partial volume
+          previousRegionLabelmap = self.segmentLabelmapInGeometry(segment, fractionalRegion)
+
       modMode = slicer.qSlicerSegmentEditorAbstractEffect.ModificationModeAdd
       if operationName == "ERASE_INSIDE" or operationName == "ERASE_OUTSIDE":
         modMode = slicer.qSlicerSegmentEditorAbstractEffect.ModificationModeRemove
@@ -312,6 +341,12 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
 
       self.scriptedEffect.modifySelectedSegmentByLabelmap(modifierLabelmap, modMode)
 
+      if previousRegionLabelmap:
+        fractionalLabelmap = self.computeFractionalLabelmap(WorldToModifierLabelmapIjkTransformer.GetOutput(),
+          stencilToImage.GetOutput(), operationName, segment, modifierLabelmap, fractionalRegion, previousRegionLabelmap)
+        if fractionalLabelmap:
+          self.createFractionalVolume(segmentationNode, segment, operationName, fractionalLabelmap)
+
       import numpy
       n = self.segmentMarkupNode.GetNumberOfFiducials()
       # get fiducial positions
@@ -320,8 +355,6 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
         coord = [0.0, 0.0, 0.0]
         self.segmentMarkupNode.GetNthFiducialPosition(i, coord)
         fPos[i] = coord
-      segmentID = self.scriptedEffect.parameterSetNode().GetSelectedSegmentID()
-      segment = segmentationNode.GetSegmentation().GetSegment(segmentID)
       segment.SetTag("fP", fPos.tostring())
       segment.SetTag("fN", n)
 
@@ -331,6 +364,196 @@ class SegmentEditorEffect(AbstractScriptedSegmentEditorEffect):
     self.observeSegmentation(True)
     qt.QApplication.restoreOverrideCursor()
 
+  def computeSurfaceCoverage(self, surfaceIjk, insideMask, extent):
+    """
+    Compute the fraction of each voxel covered by the surface.
+    Only the boundary shell of the binary inside mask is evaluated, using the distance
+    of the voxel center to the surface; all other voxels keep their binary value.
+    """
+    import numpy
+    from vtk.util import numpy_support
+
+    coverage = insideMask.astype(numpy.float32)
+
+    # Boundary shell: voxels that have a 6-neighbor with a different inside/outside state
+    boundary = numpy.zeros(insideMask.shape, dtype=bool)
+    for axis in range(3):
+      lower = [slice(None)] * 3
+      upper = [slice(None)] * 3
+      lower[axis] = slice(None, -1)
+      upper[axis] = slice(1, None)
+      differs = insideMask[tuple(lower)] != insideMask[tuple(upper)]
+      boundary[tuple(lower)] |= differs
+      boundary[tuple(upper)] |= differs
+    if not boundary.any():
+      return coverage
+
+    # Evaluate distance of all shell voxel centers at once
+    boundaryIjk = numpy.argwhere(boundary)[:, ::-1] + [extent[0], extent[2], extent[4]]
+    boundaryPoints = numpy_support.numpy_to_vtk(boundaryIjk.astype(numpy.float64), deep=1)
+    boundaryDistances = vtk.vtkDoubleArray()
+    signedDistance = vtk.vtkImplicitPolyDataDistance()
+    signedDistance.SetInput(surfaceIjk)
+    signedDistance.FunctionValue(boundaryPoints, boundaryDistances)
+
+    # The sign of the distance depends on the surface winding, which is flipped if the IJK to world
+    # transform is mirrored, therefore the side is taken from the inside mask.
+    # Surface is in IJK coordinates, so a voxel is a unit cube and a planar surface crossing it
+    # at distance d from its center covers approximately 0.5 + d of it on the side of the center.
+    distance = numpy.abs(numpy_support.vtk_to_numpy(boundaryDistances))
+    coverage[boundary] = numpy.clip(numpy.where(insideMask[boundary], 0.5 + distance, 0.5 - distance), 0.0, 1.0)
+
+    return coverage
+
+  def fractionalRegionGeometry(self, surfaceIjk, modifierLabelmap):
+    """
+    Get geometry of the region where partial volume is computed: the bounding box of the surface
+    padded by one voxel, so that the shell outside the surface is included, clipped to the modifier labelmap.
+    Returns None if the surface does not overlap the modifier labelmap.
+    """
+    import math
+    import vtkSegmentationCorePython as vtkSegmentationCore
+
+    boundsIjk = surfaceIjk.GetBounds()
+    modifierExtent = modifierLabelmap.GetExtent()
+    regionExtent = [0, -1, 0, -1, 0, -1]
+    for axis in range(3):
+      regionExtent[axis*2] = max(modifierExtent[axis*2], int(math.floor(boundsIjk[axis*2])) - 1)
+      regionExtent[axis*2+1] = min(modifierExtent[axis*2+1], int(math.ceil(boundsIjk[axis*2+1])) + 1)
+      if regionExtent[axis*2] > regionExtent[axis*2+1]:
+        return None
+
+    regionGeometry = vtkSegmentationCore.vtkOrientedImageData()
+    regionGeometry.SetExtent(regionExtent)
+    imageToWorld = vtk.vtkMatrix4x4()
+    modifierLabelmap.GetImageToWorldMatrix(imageToWorld)
+    regionGeometry.SetImageToWorldMatrix(imageToWorld)
+    return regionGeometry
+
+  def segmentLabelmapInGeometry(self, segment, referenceGeometry):
+    """
+    Get binary labelmap of the segment resampled to the reference geometry.
+    Returns None if resampling fails.
+    """
+    import vtkSegmentationCorePython as vtkSegmentationCore
+
+    resampledSegmentLabelmap = vtkSegmentationCore.vtkOrientedImageData()
+    segmentLabelmap = segment.GetRepresentation(vtkSegmentationCore.vtkSegmentationConverter.GetSegmentationBinaryLabelmapRepresentationName())
+    if segmentLabelmap is None or segmentLabelmap.IsEmpty():
+      resampledSegmentLabelmap.SetExtent(referenceGeometry.GetExtent())
+      imageToWorld = vtk.vtkMatrix4x4()
+      referenceGeometry.GetImageToWorldMatrix(imageToWorld)
+      resampledSegmentLabelmap.SetImageToWorldMatrix(imageToWorld)
+      resampledSegmentLabelmap.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+      resampledSegmentLabelmap.GetPointData().GetScalars().Fill(0)
+      return resampledSegmentLabelmap
+
+    if (not vtkSegmentationCore.vtkOrientedImageDataResample.ResampleOrientedImageToReferenceOrientedImage(
+        segmentLabelmap, referenceGeometry, resampledSegmentLabelmap)
+        or resampledSegmentLabelmap.GetExtent() != referenceGeometry.GetExtent()):
+      logging.error("segmentLabelmapInGeometry: Failed to resample segment labelmap, fractional output is skipped")
+      return None
+    return resampledSegmentLabelmap
+
+  def computeFractionalLabelmap(self, surfaceIjk, stencilImage, operationName, segment, modifierLabelmap, regionGeometry, previousRegionLabelmap):
+    """
+    Compute fractional labelmap of the segment after the operation is applied, in modifier labelmap geometry.
+    Partial volume is only computed in the region geometry, other voxels are taken from the binary segment.
+    previousRegionLabelmap is the segment before the edit in the region geometry.
+    Partial values are only kept where they agree with the binary result, which includes masking.
+    Returns None if the segment cannot be resampled.
+    """
+    import numpy
+    import vtkSegmentationCorePython as vtkSegmentationCore
+    from vtk.util import numpy_support
+
+    # Encoded as char scalars, 0% at -108, 100% at 108, so that thresholding at 0 gives the binary labelmap
+    scalarRange = [-108, 108]
+
+    segmentLabelmap = self.segmentLabelmapInGeometry(segment, modifierLabelmap)
+    if segmentLabelmap is None:
+      return None
+    binaryToFractional = vtk.vtkImageThreshold()
+    binaryToFractional.SetInputData(segmentLabelmap)
+    binaryToFractional.ThresholdByUpper(1)
+    binaryToFractional.SetInValue(scalarRange[1])
+    binaryToFractional.SetOutValue(scalarRange[0])
+    binaryToFractional.ReplaceInOn()
+    binaryToFractional.ReplaceOutOn()
+    binaryToFractional.SetOutputScalarTypeToChar()
+    binaryToFractional.Update()
+    fractionalLabelmap = vtkSegmentationCore.vtkOrientedImageData()
+    fractionalLabelmap.ShallowCopy(binaryToFractional.GetOutput())
+    imageToWorld = vtk.vtkMatrix4x4()
+    modifierLabelmap.GetImageToWorldMatrix(imageToWorld)
+    fractionalLabelmap.SetImageToWorldMatrix(imageToWorld)
+
+    def subRegion(array, arrayExtent, regionExtent):
+      return array[
+        regionExtent[4]-arrayExtent[4]:regionExtent[5]-arrayExtent[4]+1,
+        regionExtent[2]-arrayExtent[2]:regionExtent[3]-arrayExtent[2]+1,
+        regionExtent[0]-arrayExtent[0]:regionExtent[1]-arrayExtent[0]+1]
+
+    def imageArray(image):
+      dimensions = image.GetDimensions()
+      return numpy_support.vtk_to_numpy(image.GetPointData().GetScalars()).reshape(dimensions[2], dimensions[1], dimensions[0])
+
+    modifierExtent = modifierLabelmap.GetExtent()
+    regionExtent = regionGeometry.GetExtent()
+    regionFractional = subRegion(imageArray(fractionalLabelmap), modifierExtent, regionExtent)
+
+    # Voxels inside the surface. Voxels outside the stencil are outside the surface.
+    regionDimensions = [regionExtent[axis*2+1] - regionExtent[axis*2] + 1 for axis in range(3)]
+    insideMask = numpy.zeros((regionDimensions[2], regionDimensions[1], regionDimensions[0]), dtype=bool)
+    stencilExtent = stencilImage.GetExtent()
+    stencilOverlapExtent = [0, -1, 0, -1, 0, -1]
+    for axis in range(3):
+      stencilOverlapExtent[axis*2] = max(regionExtent[axis*2], stencilExtent[axis*2])
+      stencilOverlapExtent[axis*2+1] = min(regionExtent[axis*2+1], stencilExtent[axis*2+1])
+    if all(stencilOverlapExtent[axis*2] <= stencilOverlapExtent[axis*2+1] for axis in range(3)):
+      stencilArray = subRegion(imageArray(stencilImage), stencilExtent, stencilOverlapExtent)
+      # For outside operations the stencil image is 0 inside the surface
+      if operationName in ("FILL_INSIDE", "ERASE_INSIDE", "SET"):
+        subRegion(insideMask, regionExtent, stencilOverlapExtent)[:] = stencilArray > 0
+      else:
+        subRegion(insideMask, regionExtent, stencilOverlapExtent)[:] = stencilArray == 0
+    coverage = self.computeSurfaceCoverage(surfaceIjk, insideMask, regionExtent)
+
+    # Fraction of each voxel that the operation adds, removes, or sets
+    if operationName in ("FILL_INSIDE", "ERASE_INSIDE", "SET"):
+      effectFraction = coverage
+    else:
+      effectFraction = 1.0 - coverage
+
+    if operationName == "SET":
+      fraction = effectFraction
+    else:
+      fraction = (imageArray(previousRegionLabelmap) > 0).astype(numpy.float32)
+      if operationName in ("FILL_INSIDE", "FILL_OUTSIDE"):
+        fraction = numpy.maximum(fraction, effectFraction)
+      else:
+        fraction = numpy.minimum(fraction, 1.0 - effectFraction)
+
+    # Where the binary result disagrees (masking, rounding at 50%) the binary value is kept
+    encodedFraction = numpy.round(scalarRange[0] + fraction * (scalarRange[1] - scalarRange[0])).astype(numpy.int8)
+    regionFractional[:] = numpy.where((encodedFraction > 0) == (regionFractional > 0), encodedFraction, regionFractional)
+
+    return fractionalLabelmap
+
+  def createFractionalVolume(self, segmentationNode, segment, operationName, fractionalLabelmap):
+    """
+    Store fractional labelmap in a new volume node named after the cut.
+    The volume is not linked to the segment, as it is not updated by undo or later edits of the segment.
+    """
+    volumeName = slicer.mrmlScene.GenerateUniqueName(segment.GetName() + " " + operationName + " fractional")
+    fractionalVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", volumeName)
+    fractionalVolumeNode.CreateDefaultDisplayNodes()
+    slicer.vtkSlicerSegmentationsModuleLogic.CopyOrientedImageDataToVolumeNode(fractionalLabelmap, fractionalVolumeNode)
+    # Fractional labelmap is in segmentation coordinate system
+    fractionalVolumeNode.SetAndObserveTransformNodeID(segmentationNode.GetTransformNodeID())
+    logging.info("createFractionalVolume: Fractional labelmap of the cut is stored in " + volumeName)
+    return fractionalVolumeNode
+
   def observeSegmentation(self, observationEnabled):
     import vtkSegmentationCorePython as vtkSegmentationCore
     if self.scriptedEffect.parameterSetNode().GetSegmentationNode():